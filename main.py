@@ -4,12 +4,22 @@ FINAL main.py — Save documents in EXACT order/format (website-compatible)
 
 import os
 import re
+import signal
+import asyncio
 import logging
-from datetime import datetime
-import requests
-from pymongo import MongoClient, ReturnDocument
+from collections import OrderedDict
+from itertools import islice
+import aiohttp
+import orjson
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from aiohttp_client_cache.cache_control import DO_NOT_CACHE
+from async_lru import alru_cache
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.write_concern import WriteConcern
 from telegram import Update
 from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,6 +30,7 @@ TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 MONGODB_URI = os.getenv("MONGODB_URI")
 DB = os.getenv("MONGO_DB_NAME", "moviesdb")
 COL = os.getenv("MONGO_COLLECTION", "movies")
+MIN_FILE_SIZE = int(os.getenv("MIN_FILE_SIZE", "0"))  # bytes; smaller media is ignored
 
 if not BOT_TOKEN or not TMDB_API_KEY or not MONGODB_URI:
     raise SystemExit("Missing ENV: BOT_TOKEN / TMDB_API_KEY / MONGODB_URI")
@@ -29,20 +40,69 @@ logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=lo
 logger = logging.getLogger(__name__)
 
 # Mongo
-client = MongoClient(MONGODB_URI)
+client = AsyncIOMotorClient(MONGODB_URI, maxPoolSize=50)
 db = client[DB]
 collection = db[COL]
+# ingest path is idempotent (re-posting recovers state), so skip write acks there.
+# With w=0 server-side rejections (duplicate keys, or the pipeline upsert on a
+# server older than MongoDB 4.2, which is required) are not reported back.
+ingest_collection = collection.with_options(write_concern=WriteConcern(w=0))
+
+# Write batching: upserts are flushed via bulk_write when the batch is full
+# or at most BATCH_IDLE_SECONDS after the first post of a batch was queued
+BATCH_SIZE = 100
+BATCH_IDLE_SECONDS = 2
+CONCURRENT_UPDATES = 8  # channel posts handled in parallel
+pending = {}  # (title, releaseDate) -> UpdateOne; a newer post replaces an older one
+pending_lock = asyncio.Lock()
+# handlers run concurrently and finish in TMDB/cache-latency order, so each
+# upsert carries its update_id (increases in posting order) and an older post
+# never replaces a newer one for the same movie, queued or already sent
+_latest_update_ids = OrderedDict()  # (title, releaseDate) -> newest update_id
+LATEST_UPDATE_IDS_MAX = 4096
+_flush_timer = None
+
+# TMDB HTTP session (keep-alive + connection pooling + on-disk response cache)
+TMDB_BASE = "https://api.themoviedb.org/3"
+_IMG_BASE = "https://image.tmdb.org/t/p/original"
+TMDB_TIMEOUT = aiohttp.ClientTimeout(total=10)
+TMDB_CACHE_TTL = 7 * 24 * 3600  # seconds; movie details on disk
+TMDB_SEARCH_TTL = 3600  # seconds; in-memory search hits, so newly added films show up
+_http = None
+
+def get_http():
+    # created lazily so it binds to the running event loop
+    global _http
+    if _http is None or _http.closed:
+        _http = CachedSession(
+            cache=SQLiteBackend(
+                "tmdb_cache",
+                expire_after=TMDB_CACHE_TTL,
+                # searches are only cached in memory (see _tmdb_search_cached)
+                urls_expire_after={"api.themoviedb.org/3/search": DO_NOT_CACHE},
+                ignored_params=["api_key"],
+            ),
+            connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60),
+            timeout=TMDB_TIMEOUT,
+        )
+    return _http
+
+# Caption parsing patterns
+_YEAR_RE = re.compile(r"\b(19|20)\d{2}\b")
+_BRACKETS_RE = re.compile(r"\[.*?\]|\(.*?\)|\{.*?\}")
+_PUNCT_RE = re.compile(r"[^\w\s]")
+_WS_RE = re.compile(r"\s+")
 
 # Helpers
 def extract_title_year(caption: str):
     if not caption:
         return {"title": "", "year": None}
-    year_match = re.search(r"\b(19|20)\d{2}\b", caption)
+    year_match = _YEAR_RE.search(caption)
     year = year_match.group(0) if year_match else None
     text = caption.lower()
-    text = re.sub(r"\[.*?\]|\(.*?\)|\{.*?\}", " ", text)
-    text = re.sub(r"[^\w\s]", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
+    text = _BRACKETS_RE.sub(" ", text)
+    text = _PUNCT_RE.sub(" ", text)
+    text = _WS_RE.sub(" ", text).strip()
     if year:
         text = text.replace(year, "").strip()
     title = " ".join([w.capitalize() for w in text.split()]) if text else ""
@@ -58,84 +118,124 @@ def detect_category(caption: str):
         return "bollywood"
     return "hollywood"
 
-def tmdb_search(query, year=None):
+# in-memory layer for repeated captions. Never raises: searches that lost in
+# first_nonempty have no waiter left to retrieve an exception. Errors and
+# empty results are dropped from the cache once the call settles (not in
+# tmdb_search, which a losing search never returns to), so they're retried.
+@alru_cache(maxsize=2048, ttl=TMDB_SEARCH_TTL)
+async def _tmdb_search_cached(query, year):
     params = {"api_key": TMDB_API_KEY, "query": query}
     if year: params["year"] = year
     try:
-        r = requests.get("https://api.themoviedb.org/3/search/movie", params=params, timeout=10)
-        r.raise_for_status()
-        return r.json().get("results", [])
+        async with get_http().get(f"{TMDB_BASE}/search/movie", params=params) as r:
+            r.raise_for_status()
+            results = orjson.loads(await r.read()).get("results", [])
     except Exception as e:
         logger.exception("TMDB search failed: %s", e)
-        return []
+        results = []
+    if not results:
+        asyncio.get_running_loop().call_soon(_tmdb_search_cached.cache_invalidate, query, year)
+    return results
 
-def tmdb_details(id):
+async def tmdb_search(query, year=None):
+    return await _tmdb_search_cached(query, year)
+
+async def tmdb_details(id):
     try:
-        r = requests.get(
-            f"https://api.themoviedb.org/3/movie/{id}",
+        async with get_http().get(
+            f"{TMDB_BASE}/movie/{id}",
             params={"api_key": TMDB_API_KEY, "append_to_response": "videos,credits"},
-            timeout=10
-        )
-        r.raise_for_status()
-        return r.json()
+        ) as r:
+            r.raise_for_status()
+            return orjson.loads(await r.read())
     except Exception as e:
         logger.exception("TMDB details failed: %s", e)
         return None
 
-def build_img(path):
-    return f"https://image.tmdb.org/t/p/original{path}" if path else ""
+# in-flight details lookups, so concurrent posts of the same movie share one request
+_details_inflight = {}
+
+async def tmdb_details_coalesced(id):
+    fut = _details_inflight.get(id)
+    if fut is None:
+        fut = asyncio.ensure_future(tmdb_details(id))
+        _details_inflight[id] = fut
+        fut.add_done_callback(lambda _: _details_inflight.pop(id, None))
+    # shield: one cancelled waiter must not cancel the lookup for the others
+    return await asyncio.shield(fut)
+
+async def first_nonempty(*coros):
+    # run all concurrently, return the first non-empty result in priority order.
+    # Cancelling the losers only stops waiting on them: _tmdb_search_cached
+    # shields its request, so they finish on purpose and fill the search cache
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        for t in tasks:
+            result = await t
+            if result:
+                return result
+        return []
+    finally:
+        for t in tasks:
+            t.cancel()  # releases the waiter, not the HTTP request
 
 # Build document with EXACT order
 def build_ordered_doc(tmdb, parsed_title, file_id, category):
-    # now timestamp
-    now = datetime.utcnow().isoformat() + "Z"
+    tmdb = tmdb or {}
+    credits = tmdb.get("credits") or {}
+    cast = credits.get("cast") or []
+    crew = credits.get("crew") or []
+    videos = (tmdb.get("videos") or {}).get("results") or []
 
     # actors as comma string
-    cast = (tmdb.get("credits", {}) or {}).get("cast", []) if tmdb else []
-    actors_str = ", ".join([c.get("name") for c in cast][:10]) if cast else ""
+    actors_str = ", ".join(c["name"] for c in islice(cast, 10) if c.get("name"))
 
     # director and producer as strings
-    crew = (tmdb.get("credits", {}) or {}).get("crew", []) if tmdb else []
     director = ""
     producer = ""
+    # TMDB uses canonical casing, so compare jobs as-is and stop once both are found
     for member in crew:
-        job = (member.get("job") or "").lower()
-        if job == "director" and not director:
+        job = member.get("job")
+        if job == "Director" and not director:
             director = member.get("name") or ""
-        if job == "producer" and not producer:
+        elif job == "Producer" and not producer:
             producer = member.get("name") or ""
+        if director and producer:
+            break
 
     # trailer
     trailer = ""
-    videos = (tmdb.get("videos", {}) or {}).get("results", []) if tmdb else []
     for v in videos:
-        if (v.get("type") or "").lower() == "trailer" and (v.get("site") or "").lower() == "youtube":
+        if (v.get("type"), v.get("site")) == ("Trailer", "YouTube"):
             key = v.get("key")
             if key:
                 trailer = f"https://www.youtube.com/watch?v={key}"
                 break
 
     # genres list
-    genres = [g.get("name") for g in (tmdb.get("genres") or [])] if tmdb else []
+    genres = [g.get("name") for g in (tmdb.get("genres") or [])]
+
+    poster = tmdb.get("poster_path")
+    backdrop = tmdb.get("backdrop_path")
 
     # releaseDate and runtime and rating safe
-    releaseDate = tmdb.get("release_date") if tmdb and tmdb.get("release_date") else ""
+    releaseDate = tmdb.get("release_date") or ""
     try:
-        runtime = int(tmdb.get("runtime") or 0) if tmdb else 0
+        runtime = int(tmdb.get("runtime") or 0)
     except:
         runtime = 0
     try:
-        rating = float(tmdb.get("vote_average") or 0) if tmdb else 0.0
+        rating = float(tmdb.get("vote_average") or 0)
     except:
         rating = 0.0
 
     # Build ordered dict (regular dict in Python3.7+ preserves insertion)
     doc = {
         # _id will be created by MongoDB automatically when inserting; it will still display above fields in UI
-        "title": parsed_title or (tmdb.get("title") if tmdb else "") or "",
-        "posterUrl": build_img(tmdb.get("poster_path")) if tmdb else "",
-        "backdropUrl": build_img(tmdb.get("backdrop_path")) if tmdb else "",
-        "description": tmdb.get("overview") if tmdb else "",
+        "title": parsed_title or tmdb.get("title") or "",
+        "posterUrl": _IMG_BASE + poster if poster else "",
+        "backdropUrl": _IMG_BASE + backdrop if backdrop else "",
+        "description": tmdb.get("overview") or "",
         "category": category or "hollywood",
         "actors": actors_str,
         "director": director,
@@ -148,13 +248,68 @@ def build_ordered_doc(tmdb, parsed_title, file_id, category):
         "genres": genres,
         "releaseDate": releaseDate,
         "runtime": runtime,
-        "tagline": tmdb.get("tagline") if tmdb else "",
-        "createdAt": now,
-        "updatedAt": now,
+        "tagline": tmdb.get("tagline") or "",
         "__v": 0
     }
+    # createdAt/updatedAt are set server-side by the upsert (see build_upsert)
     return doc
 
+# Single round-trip upsert. $replaceWith writes the fields in exactly this
+# order (a $set upsert would put the filter fields first). Timestamps come
+# from the server clock ($$NOW) as ISO strings like the website expects;
+# createdAt is kept when the document already exists. Values are wrapped in
+# $literal so titles or links starting with "$" aren't read as field paths.
+_NOW_ISO = {"$dateToString": {"date": "$$NOW", "format": "%Y-%m-%dT%H:%M:%S.%LZ"}}
+
+def build_upsert(doc):
+    filter_q = {"title": doc["title"], "releaseDate": doc["releaseDate"]}
+    fields = {"_id": "$_id"}
+    fields.update((k, {"$literal": v}) for k, v in doc.items() if k != "__v")
+    fields["createdAt"] = {"$ifNull": ["$createdAt", _NOW_ISO]}
+    fields["updatedAt"] = _NOW_ISO
+    fields["__v"] = {"$literal": doc.get("__v", 0)}
+    return UpdateOne(filter_q, [{"$replaceWith": fields}], upsert=True)
+
+async def queue_doc(doc, update_id):
+    global _flush_timer
+    key = (doc["title"], doc["releaseDate"])
+    async with pending_lock:
+        if update_id < _latest_update_ids.get(key, update_id):
+            logger.info("Skipping older post for: %s", doc["title"])
+            return
+        _latest_update_ids[key] = update_id
+        _latest_update_ids.move_to_end(key)
+        if len(_latest_update_ids) > LATEST_UPDATE_IDS_MAX:
+            _latest_update_ids.popitem(last=False)
+        pending[key] = build_upsert(doc)
+        full = len(pending) >= BATCH_SIZE
+    if full:
+        await flush_pending()
+        return
+    # start the timer only once per batch so steady traffic can't postpone the flush
+    if _flush_timer is None:
+        _flush_timer = asyncio.create_task(flush_later())
+
+async def flush_later():
+    global _flush_timer
+    await asyncio.sleep(BATCH_IDLE_SECONDS)
+    _flush_timer = None  # posts queued from here on start a new timer
+    await flush_pending()
+
+async def flush_pending():
+    # the write stays under the lock so flushes never overlap; with w=0 this
+    # keeps batches in send order but can't confirm the server applied them
+    async with pending_lock:
+        if not pending:
+            return
+        ops = list(pending.values())
+        pending.clear()
+        try:
+            await ingest_collection.bulk_write(ops, ordered=False)
+            logger.info("Sent %d upserts (unacknowledged)", len(ops))
+        except Exception as e:
+            logger.exception("Bulk write failed: %s", e)
+
 # Handler
 async def handle(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
@@ -165,25 +320,27 @@ async def handle(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not media:
         logger.info("Ignoring message without supported media")
         return
+    if MIN_FILE_SIZE and (media.file_size or 0) < MIN_FILE_SIZE:
+        logger.info("Ignoring media below MIN_FILE_SIZE: %s bytes", media.file_size)
+        return
 
     caption = msg.caption or ""
     parsed = extract_title_year(caption)
     title_for_search = parsed["title"] or caption or ""
     year_for_search = parsed["year"]
 
-    # TMDB search attempts
-    results = []
+    # TMDB search attempts (issued together, earlier ones win)
+    searches = []
     if year_for_search:
-        results = tmdb_search(title_for_search, year_for_search)
-    if not results:
-        results = tmdb_search(title_for_search)
-    if not results and caption and caption != title_for_search:
-        results = tmdb_search(caption)
+        searches.append(tmdb_search(title_for_search, year_for_search))
+    searches.append(tmdb_search(title_for_search))
+    if caption and caption != title_for_search:
+        searches.append(tmdb_search(caption))
+    results = await first_nonempty(*searches)
 
     if not results:
         logger.info("No TMDB result for caption: %s", caption)
         # still create minimal safe doc using caption
-        now = datetime.utcnow().isoformat() + "Z"
         category = detect_category(caption)
         file_id = media.file_id
         minimal_doc = {
@@ -200,23 +357,19 @@ async def handle(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             "telegramLinks": [file_id or ""],
             "seasons": [],
             "trailerLink": "",
-            "genres": [{"id": g["id"], "name": g["name"]} for g in tmdb.get("genres", [])],
+            "genres": [],                  # same shape as TMDB docs: list of names
             "releaseDate": parsed.get("year") or "",
             "runtime": 0,
             "tagline": "",
-            "createdAt": now,
-            "updatedAt": now,
             "__v": 0
         }
-        # upsert via find_one_and_replace to enforce order
-        filter_q = {"title": minimal_doc["title"], "releaseDate": minimal_doc["releaseDate"]}
-        res = collection.find_one_and_replace(filter_q, minimal_doc, upsert=True, return_document=ReturnDocument.AFTER)
-        logger.info("Saved minimal doc (no TMDB) id: %s", res.get("_id") if res else "unknown")
+        await queue_doc(minimal_doc, update.update_id)
+        logger.info("Queued minimal doc (no TMDB): %s", minimal_doc["title"])
         return
 
     # we have TMDB id
     tmdb_id = results[0].get("id")
-    tmdb = tmdb_details(tmdb_id) if tmdb_id else None
+    tmdb = await tmdb_details_coalesced(tmdb_id) if tmdb_id else None
     if not tmdb:
         logger.info("TMDB details not available for id: %s", tmdb_id)
         return
@@ -227,33 +380,65 @@ async def handle(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Build ordered doc
     ordered_doc = build_ordered_doc(tmdb, parsed["title"] or (tmdb.get("title") or ""), file_id, category)
 
-    # Preserve createdAt if document already exists
-    filter_q = {"title": ordered_doc["title"], "releaseDate": ordered_doc["releaseDate"]}
-    existing = collection.find_one(filter_q)
-    if existing:
-        ordered_doc["createdAt"] = existing.get("createdAt") or ordered_doc["createdAt"]
+    await queue_doc(ordered_doc, update.update_id)
+    logger.info("Queued movie: %s", ordered_doc["title"])
 
-    # Upsert by replacing full document (this keeps fields in our insertion order)
-    res = collection.find_one_and_replace(filter_q, ordered_doc, upsert=True, return_document=ReturnDocument.AFTER)
-    logger.info("Saved/updated movie: %s id: %s", ordered_doc["title"], res.get("_id") if res else "unknown")
+async def ensure_indexes():
+    # upsert filter is (title, releaseDate); unique also blocks concurrent duplicates
+    try:
+        await collection.create_index(
+            [("title", 1), ("releaseDate", 1)],
+            unique=True,
+            background=True,
+            name="title_releaseDate_uniq",
+        )
+    except Exception as e:
+        logger.warning("Could not create title/releaseDate index: %s", e)
 
 # Startup (Pella compatible)
 async def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL, handle))
+    await ensure_indexes()
+    # pooled HTTP/2 connections for Bot API calls; long polling gets its own
+    # request object so it never holds a connection the handlers need
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=20, http_version="2"))
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
+    # only video/document posts reach handle; everything else is dropped by the filter
+    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & (filters.VIDEO | filters.Document.ALL), handle))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
 
     logger.info("Bot started. Initializing...")
-    await app.initialize()
-    await app.start()
-    await app.updater.start_polling()
-    logger.info("Bot running and listening for channel posts...")
+    async with app:  # initialize() / shutdown()
+        await app.start()
+        await app.updater.start_polling()
+        logger.info("Bot running and listening for channel posts...")
+        try:
+            await stop.wait()
+        finally:
+            logger.info("Shutting down...")
+            await app.updater.stop()
+            await app.stop()
+            # don't lose queued upserts on shutdown
+            await flush_pending()
+            if _http is not None:
+                await _http.close()
 
 if __name__ == "__main__":
-    import asyncio
     try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    loop.create_task(main())
-    loop.run_forever()
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(main())